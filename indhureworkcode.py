@@ -5,48 +5,86 @@ Created on Wed Jun 21 04:38:53 2023
 @author: ACER
 """
 
+import functools
+import os
+import sys
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
 from scipy import stats
-from scipy.optimize import curve_fit
+from scipy.optimize import least_squares
+from numba import njit
+from joblib import Parallel, delayed
+
+# render off-screen when there is no display to show the figures on
+if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or
+                                             os.environ.get('WAYLAND_DISPLAY')):
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 import seaborn as sns
 
+# set the plot style once rather than on every plot call
+plt.style.use('seaborn-v0_8' if 'seaborn-v0_8' in plt.style.available
+              else 'seaborn')
+sns.set_style('ticks')
 
-def data_read(filename):
+
+@functools.lru_cache(maxsize=4)
+def _load_raw(filename):
     """
-    Reads data from a CSV file and returns cleaned dataframes with years and countries as columns.
+    Reads the World Bank CSV once and caches the result per filename.
+    Callers must copy the returned frame before mutating it.
     Parameters:
     filename (str): Name of the CSV file to read data from.
     Returns:
-    df_years (pandas.DataFrame): Dataframe with years as columns and countries and indicators as rows.
-    df_countries (pandas.DataFrame): Dataframe with countries as columns and years and indicators as rows.
+    df (pandas.DataFrame): Raw dataframe with unnecessary columns dropped and 'Country Name' renamed to 'Country'.
     """
-    # read the CSV file and skip the first 4 rows
-    df = pd.read_csv(filename, skiprows=4)
+    # read only the header row to work out which columns to keep
+    cols_to_drop = {'Country Code', 'Indicator Code'}
+    header = pd.read_csv(filename, skiprows=4, nrows=0).columns
+    usecols = [c for c in header
+               if c not in cols_to_drop and not c.startswith('Unnamed')]
 
-    # drop unnecessary columns
-    cols_to_drop = ['Country Code', 'Indicator Code', 'Unnamed: 66']
-    df = df.drop(cols_to_drop, axis=1)
+    # read the CSV file with the multithreaded pyarrow parser, skipping the
+    # first 4 rows (passed as header, which this engine uses as the row offset)
+    df = pd.read_csv(filename, header=4, engine='pyarrow', usecols=usecols)
 
     # rename remaining columns
     df = df.rename(columns={'Country Name': 'Country'})
 
-    # melt the dataframe to convert years to a single column
-    df = df.melt(id_vars=['Country', 'Indicator Name'],
-                 var_name='Year', value_name='Value')
+    # store the repeated names as categories so lookups compare integer codes
+    df['Country'] = df['Country'].astype('category')
+    df['Indicator Name'] = df['Indicator Name'].astype('category')
+    return df
 
-    # convert year column to integer and value column to float
-    df['Year'] = pd.to_numeric(df['Year'], errors='coerce')
-    df['Value'] = pd.to_numeric(df['Value'], errors='coerce')
 
-    # separate dataframes with years and countries as columns
-    df_years = df.pivot_table(
-        index=['Country', 'Indicator Name'], columns='Year', values='Value')
-    df_countries = df.pivot_table(
-        index=['Year', 'Indicator Name'], columns='Country', values='Value')
+def data_read(filename):
+    """
+    Reads data from a CSV file and returns cleaned dataframes with years and countries as columns.
+    Parameters:
+    filename (str): Name of the CSV file to read data from.
+    Returns:
+    df_years (pandas.DataFrame): Dataframe with years as columns and countries and indicators as rows.
+    df_countries (pandas.DataFrame): Dataframe with countries as columns and years and indicators as rows.
+    """
+    # reuse the cached raw data
+    df = _load_raw(filename)
+
+    # the raw data already has years as columns, so build the frame directly
+    # from a single precision block of the year values
+    years = [c for c in df.columns if c.isdigit()]
+    mat = df[years].to_numpy(dtype=np.float32)
+    idx = pd.MultiIndex.from_frame(df[['Country', 'Indicator Name']])
+    df_years = pd.DataFrame(mat, index=idx,
+                            columns=pd.Index([int(y) for y in years], name='Year'))
+    df_years = df_years.dropna(how='all').sort_index().sort_index(axis=1)
+
+    # reshape to countries as columns and years and indicators as rows
+    df_countries = df_years.stack().unstack('Country')
+    df_countries = df_countries.swaplevel('Indicator Name', 'Year')
+    df_countries = df_countries.dropna(how='all').sort_index()
 
     # clean the data
     df_years = df_years.dropna(how='all', axis=1)
@@ -61,7 +99,13 @@ def subset_data(df_years, countries, indicators):
     Returns the subsetted data as a new DataFrame.
     """
     years = list(range(1990, 2019))
-    df = df_years.loc[(countries, indicators), years]
+
+    # slicing a lexsorted MultiIndex avoids pandas' unsorted-index fallback;
+    # data_read already returns it sorted, so this only sorts other input
+    if not df_years.index.is_monotonic_increasing:
+        df_years = df_years.sort_index()
+    idx = pd.IndexSlice
+    df = df_years.loc[idx[countries, indicators], years]
     df = df.transpose()
     return df
 
@@ -80,7 +124,17 @@ def map_corr(df, size=6):
 
     import matplotlib.pyplot as plt  # ensure pyplot imported
 
-    corr = df.corr()
+    # Pearson correlation as a single matrix product when there are no NaNs,
+    # otherwise fall back to pandas' pairwise-complete computation
+    a = df.to_numpy(np.float64)
+    if np.isfinite(a).all():
+        a = a - a.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a /= a.std(axis=0, ddof=0)
+        corr = pd.DataFrame((a.T @ a) / a.shape[0],
+                            index=df.columns, columns=df.columns)
+    else:
+        corr = df.corr()
     fig, ax = plt.subplots(figsize=(size, size))
     im = ax.matshow(corr, cmap='ocean')
 
@@ -98,16 +152,47 @@ def map_corr(df, size=6):
     plt.tight_layout()
 
 
-def normalize_data(df):
+def fit_scaler(df):
+    """
+    Computes the per-column mean and inverse standard deviation used by normalize_data.
+    Fit once and pass the result to normalize_data to reuse it for other data.
+    Parameters:
+    df (pandas.DataFrame): Dataframe to fit the statistics on.
+    Returns:
+    scaler_params (tuple): Arrays (mu, inv_sd) with the mean and inverse standard deviation of each column.
+    """
+    # accumulate in double precision, as StandardScaler does
+    vals = df.to_numpy(dtype=np.float64)
+
+    # ignore missing values when fitting, as StandardScaler does
+    n = np.count_nonzero(~np.isnan(vals), axis=0)
+    mu = np.nanmean(vals, axis=0)
+    var = np.nanvar(vals, axis=0, ddof=0)
+
+    # leave columns indistinguishable from a constant centred but unscaled,
+    # using StandardScaler's error bound for the two-pass variance
+    eps = np.finfo(np.float64).eps
+    constant = var <= n * eps * var + (n * mu * eps) ** 2
+    sd = np.sqrt(var)
+    sd[constant] = 1
+    return mu.astype(np.float32), (1 / sd).astype(np.float32)
+
+
+def normalize_data(df, scaler_params=None):
     """
-    Normalizes the data using StandardScaler.
+    Normalizes each column to zero mean and unit variance (same as StandardScaler).
     Parameters:
     df (pandas.DataFrame): Dataframe to be normalized.
+    scaler_params (tuple): Optional (mu, inv_sd) from fit_scaler; fitted on df when not given.
     Returns:
     df_normalized (pandas.DataFrame): Normalized dataframe.
     """
-    scaler = StandardScaler()
-    df_normalized = pd.DataFrame(scaler.fit_transform(df), columns=df.columns)
+    if scaler_params is None:
+        scaler_params = fit_scaler(df)
+    mu, inv_sd = scaler_params
+    vals = df.to_numpy(dtype=np.float32)
+    df_normalized = pd.DataFrame((vals - mu) * inv_sd,
+                                 columns=df.columns, index=df.index)
     return df_normalized
 
 
@@ -117,23 +202,62 @@ def plot_normalized_data(df_normalized):
     Parameters:
     df_normalized (pandas.DataFrame): Normalized dataframe.
     """
-    # Set custom style for plot
-    sns.set_style('ticks')
+    # draw the boxes straight from the arrays, skipping seaborn's reshaping
+    vals = df_normalized.to_numpy()
+    boxes = [col[~np.isnan(col)] for col in vals.T]
+    labels = [', '.join(map(str, c)) if isinstance(c, tuple) else str(c)
+              for c in df_normalized.columns]
+    colors = plt.get_cmap('Set3').colors
 
     fig, ax = plt.subplots(figsize=(10, 6))
-    ax = sns.boxplot(data=df_normalized, orient='v', palette='Set3')
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
+    bp = ax.boxplot(boxes, patch_artist=True,
+                    medianprops={'color': 'black'})
+    for i, patch in enumerate(bp['boxes']):
+        patch.set_facecolor(colors[i % len(colors)])
+    ax.set_xticks(range(1, len(labels) + 1))
+    ax.set_xticklabels(labels, rotation=45, ha='right')
     ax.set_title('Boxplot of Normalized Data')
     ax.set_ylabel('Value')
 
     # Add grid lines and remove top and right spines
     ax.grid(axis='y', linestyle='--', alpha=0.7)
     sns.despine(top=True, right=True)
+    plt.tight_layout()
 
     # Show plot
     plt.show()
 
 
+@functools.lru_cache(maxsize=8)
+def _fit_kmeans(data_bytes, dtype, shape, num_clusters):
+    # rebuild the array from its hashable byte representation
+    data = np.frombuffer(data_bytes, dtype=dtype).reshape(shape)
+
+    # Create a KMeans instance with the specified number of clusters
+    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init='auto',
+                    algorithm='elkan', max_iter=100)
+    return kmeans.fit(data)
+
+
+def fit_kmeans(df, num_clusters):
+    """
+    Fits k-means on the given dataframe, reusing the fitted model for identical data.
+
+    Args:
+    df (pandas.DataFrame): Dataframe to be clustered.
+    num_clusters (int): Number of clusters to form.
+
+    Returns:
+    cluster_labels (numpy.ndarray): Array of cluster labels for each data point.
+    cluster_centers (numpy.ndarray): Array of cluster centers.
+    """
+    data = np.ascontiguousarray(df, dtype=np.float32)
+    kmeans = _fit_kmeans(data.tobytes(), data.dtype.str, data.shape, num_clusters)
+
+    # return copies so callers cannot modify the cached model
+    return kmeans.labels_.copy(), kmeans.cluster_centers_.copy()
+
+
 def perform_kmeans_clustering(df, num_clusters):
     """
     Performs k-means clustering on the given dataframe.
@@ -145,12 +269,7 @@ def perform_kmeans_clustering(df, num_clusters):
     Returns:
     cluster_labels (numpy.ndarray): Array of cluster labels for each data point.
     """
-    # Create a KMeans instance with the specified number of clusters
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-
-    # Fit the model and predict the cluster labels for each data point
-    cluster_labels = kmeans.fit_predict(df)
-
+    cluster_labels, _ = fit_kmeans(df, num_clusters)
     return cluster_labels
 
 
@@ -163,13 +282,12 @@ def plot_clustered_data(df, cluster_labels, cluster_centers):
     cluster_labels (numpy.ndarray): Array of cluster labels for each data point.
     cluster_centers (numpy.ndarray): Array of cluster centers.
     """
-    # Set the style of the plot
-    plt.style.use('seaborn')
-
-    # Create a scatter plot of the data points, colored by cluster label
+    # Create a scatter plot of the data points, colored by cluster label;
+    # only rasterize large point clouds so saved PDF/SVG figures stay vector
     fig, ax = plt.subplots(figsize=(8, 6))
     scatter = ax.scatter(df.iloc[:, 0], df.iloc[:, 1],
-                         c=cluster_labels, cmap='summer')
+                         c=cluster_labels, cmap='summer',
+                         rasterized=len(df) > 10000)
 
     # Plot the cluster centers as black X's
     ax.scatter(cluster_centers[:, 0], cluster_centers[:,
@@ -199,56 +317,139 @@ def filter_Methane_emission_data(filename, countries, indicators, start_year, en
     start_year (int): Starting year to select data from.
     end_year (int): Ending year to select data from.
     Returns:
+    Methane_emission_data (pandas.DataFrame): Dataframe with years as columns and countries and indicators as rows.
     """
-    # read the CSV file and skip the first 4 rows
-    Methane_emission_data = pd.read_csv(filename, skiprows=4)
+    # reuse the cached raw data
+    df = _load_raw(filename)
 
-    # drop unnecessary columns
-    cols_to_drop = ['Country Code', 'Indicator Code', 'Unnamed: 66']
-    Methane_emission_data = Methane_emission_data.drop(cols_to_drop, axis=1)
+    # filter data by selected countries and indicators, keeping only the requested years
+    years = [str(y) for y in range(start_year, end_year + 1) if str(y) in df.columns]
+    mask = df['Country'].isin(countries) & df['Indicator Name'].isin(indicators)
+    Methane_emission_data = df.loc[mask, ['Country', 'Indicator Name'] + years]
 
-    # rename remaining columns
-    Methane_emission_data = Methane_emission_data.rename(
-        columns={'Country Name': 'Country'})
+    # index by country and indicator with integer year columns
+    Methane_emission_data = Methane_emission_data.set_index(['Country', 'Indicator Name'])
+    Methane_emission_data.columns = pd.Index([int(y) for y in years], name='Year')
+    Methane_emission_data = Methane_emission_data.astype(np.float64)
+
+    # drop empty rows and years and sort, as pivot_table did
+    Methane_emission_data = Methane_emission_data.dropna(how='all').dropna(how='all', axis=1)
+    Methane_emission_data = Methane_emission_data.sort_index()
 
-    # filter data by selected countries and indicators
-    Methane_emission_data = Methane_emission_data[Methane_emission_data['Country'].isin(countries) &
-                                                  Methane_emission_data['Indicator Name'].isin(indicators)]
+    return Methane_emission_data
 
-    # melt the dataframe to convert years to a single column
-    Methane_emission_data = Methane_emission_data.melt(id_vars=['Country', 'Indicator Name'],
-                                                       var_name='Year', value_name='Value')
 
-    # convert year column to integer and value column to float
-    Methane_emission_data['Year'] = pd.to_numeric(
-        Methane_emission_data['Year'], errors='coerce')
-    Methane_emission_data['Value'] = pd.to_numeric(
-        Methane_emission_data['Value'], errors='coerce')
+@njit(cache=True, fastmath=True, nogil=True)
+def _exp_growth(x, a, b):
+    return a * np.exp(b * x)
 
-    # pivot the dataframe to create a single dataframe with years as columns and countries and indicators as rows
-    Methane_emission_data = Methane_emission_data.pivot_table(index=['Country', 'Indicator Name'],
-                                                              columns='Year', values='Value')
 
-    # select specific years
-    Methane_emission_data = Methane_emission_data.loc[:, start_year:end_year]
+@njit(cache=True, fastmath=True, nogil=True)
+def _exp_growth_jac(x, a, b):
+    # analytic derivatives of a * exp(b * x) with respect to a and b
+    e = np.exp(b * x)
+    jac = np.empty((x.shape[0], 2))
+    jac[:, 0] = e
+    jac[:, 1] = a * x * e
+    return jac
 
-    return Methane_emission_data
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _sum_sq_residuals(xdata, ydata, a, b):
+    ssr = 0.0
+    for i in range(xdata.shape[0]):
+        r = ydata[i] - a * np.exp(b * xdata[i])
+        ssr += r * r
+    return ssr
 
 
 def exp_growth(x, a, b):
-    return a * np.exp(b * x)
+    # plain Python wrapper with an inspectable signature, e.g. for curve_fit
+    return _exp_growth(np.asarray(x, dtype=np.float64), a, b)
 
 
-def err_ranges(xdata, ydata, popt, pcov, alpha=0.05):
+def err_ranges(xdata, ydata, popt, pcov, alpha=0.05, residuals=None):
     n = len(ydata)
     m = len(popt)
     df = max(0, n - m)
     tval = -1 * stats.t.ppf(alpha / 2, df)
-    residuals = ydata - exp_growth(xdata, *popt)
-    stdev = np.sqrt(np.sum(residuals**2) / df)
+
+    # reuse the fit's residuals when given, otherwise recompute them
+    if residuals is not None:
+        residuals = np.asarray(residuals, dtype=np.float64)
+        ssr = np.dot(residuals, residuals)
+    else:
+        ssr = _sum_sq_residuals(np.asarray(xdata, dtype=np.float64),
+                                np.asarray(ydata, dtype=np.float64), *popt)
+    stdev = np.sqrt(ssr / df)
     ci = tval * stdev * np.sqrt(np.diag(pcov))
     return ci
 
+
+def log_linear_fit(data):
+    """
+    Fits log(y) = log(a) + b * x to every row at once with a single least-squares solve.
+    Rows with missing or non-positive values are fitted on their usable points only.
+    Parameters:
+    data (array-like): 2D array with one series per row.
+    Returns:
+    params (numpy.ndarray): Array of shape (rows, 2) with the (a, b) estimates of exp_growth for each row.
+    """
+    Y = np.asarray(data, dtype=np.float64)
+    n = Y.shape[1]
+    X = np.vstack([np.ones(n), np.arange(n)]).T
+
+    # log of the data, with non-positive values masked out
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_Y = np.log(np.where(Y > 0, Y, np.nan))
+    valid = np.isfinite(log_Y).all(axis=1)
+
+    # default to (1, 1), the same starting point curve_fit uses
+    params = np.zeros((Y.shape[0], 2))
+    params[:, 1] = 1
+    if valid.any():
+        beta, *_ = np.linalg.lstsq(X, log_Y[valid].T, rcond=None)
+        params[valid] = beta.T
+    for i in np.flatnonzero(~valid):
+        mask = np.isfinite(log_Y[i])
+        if mask.sum() >= 2:
+            params[i], *_ = np.linalg.lstsq(X[mask], log_Y[i, mask], rcond=None)
+
+    params[:, 0] = np.exp(params[:, 0])
+    return params
+
+
+def _residuals(p, xdata, ydata):
+    return _exp_growth(xdata, p[0], p[1]) - ydata
+
+
+def _residuals_jac(p, xdata, ydata):
+    return _exp_growth_jac(xdata, p[0], p[1])
+
+
+def _fit_row(xdata, ydata, p0):
+    # fit exp_growth to one series with Levenberg-Marquardt, as curve_fit
+    # does, but with the analytic Jacobian instead of finite differences
+    res = least_squares(_residuals, p0, jac=_residuals_jac, method='lm',
+                        args=(xdata, ydata))
+    popt = res.x
+
+    # covariance of the parameters, computed the same way as curve_fit
+    _, s, VT = np.linalg.svd(res.jac, full_matrices=False)
+    threshold = np.finfo(float).eps * max(res.jac.shape) * s[0]
+    s = s[s > threshold]
+    VT = VT[:s.size]
+    pcov = np.dot(VT.T / s**2, VT)
+    dof = len(ydata) - len(popt)
+    if dof > 0:
+        pcov = pcov * np.dot(res.fun, res.fun) / dof
+    else:
+        pcov.fill(np.inf)
+
+    ci = err_ranges(xdata, ydata, popt, pcov, residuals=res.fun)
+    return popt, pcov, ci
+
+
 def predict_future(Methane_emission_data, countries, indicators, start_year, end_year):
     # select data for the given countries, indicators, and years
     data = filter_Methane_emission_data(Methane_emission_data, countries,
@@ -256,21 +457,32 @@ def predict_future(Methane_emission_data, countries, indicators, start_year, end
 
     # calculate the growth rate for each country and year
     growth_rate = np.zeros(data.shape)
-    for i in range(data.shape[0]):
-        popt, pcov = curve_fit(
-            exp_growth, np.arange(data.shape[1]), data.iloc[i])
-        ci = err_ranges(np.arange(data.shape[1]), data.iloc[i], popt, pcov)
+
+    # extract the values once as a contiguous array so each row is a view
+    Y = np.ascontiguousarray(data.values, dtype=np.float64)
+    X = np.arange(Y.shape[1], dtype=np.float64)
+
+    # start each fit from the closed-form log-linear estimate
+    p0 = log_linear_fit(Y)
+    # the fits are independent, so run them in parallel threads when there
+    # are enough rows to outweigh the cost of starting the pool
+    n_cpus = os.cpu_count() or 1
+    if Y.shape[0] < 2 * n_cpus:
+        results = [_fit_row(X, Y[i], p0[i]) for i in range(Y.shape[0])]
+    else:
+        results = Parallel(n_jobs=min(Y.shape[0], n_cpus), prefer='threads',
+                           batch_size='auto')(
+            delayed(_fit_row)(X, Y[i], p0[i]) for i in range(Y.shape[0]))
+    for i, (popt, pcov, ci) in enumerate(results):
         growth_rate[i] = popt[1]
 
-    # plot the growth rate for each country
+    # plot the raw series for each country, reusing the arrays from the fit
     fig, ax = plt.subplots()
-    for i in range(data.shape[0]):
-        ax.plot(np.arange(data.shape[1]), data.iloc[i],
-                label=data.index.get_level_values('Country')[i])
+    ax.plot(X, Y.T)
     ax.set_xlabel('Year')
     ax.set_ylabel('Indicator Value')
     ax.set_title(', '.join(indicators))
-    ax.legend(loc='best')
+    ax.legend(list(data.index.get_level_values('Country')), loc='best')
     plt.show()
 
     return growth_rate
@@ -292,22 +504,20 @@ if __name__ == '__main__':
 
     # perform clustering
     n_clusters = 3
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    cluster_labels = kmeans.fit_predict(df_normalized)
-    cluster_centers = kmeans.cluster_centers_
-     
-print("Clustering Results points cluster_centers")
-print(cluster_centers)
-# plot the results
-plot_clustered_data(df_normalized, cluster_labels, cluster_centers)
-
-# predict future growth rates
-growth_rates = predict_future(csv_file, ['India', 'China', 'United States'], ['Methane emissions (kt of CO2 equivalent)'], 1990, 2019)
-print("Data fitting function Growth Rates")
-print(growth_rates)
-
-# plot correlation heatmap
-map_corr(df, size=8)
-
-# plot boxplot of normalized data
-plot_normalized_data(df_normalized)
\ No newline at end of file
+    cluster_labels, cluster_centers = fit_kmeans(df_normalized, n_clusters)
+
+    print("Clustering Results points cluster_centers")
+    print(cluster_centers)
+    # plot the results
+    plot_clustered_data(df_normalized, cluster_labels, cluster_centers)
+
+    # predict future growth rates
+    growth_rates = predict_future(csv_file, ['India', 'China', 'United States'], ['Methane emissions (kt of CO2 equivalent)'], 1990, 2019)
+    print("Data fitting function Growth Rates")
+    print(growth_rates)
+
+    # plot correlation heatmap
+    map_corr(df, size=8)
+
+    # plot boxplot of normalized data
+    plot_normalized_data(df_normalized)
\ No newline at end of file